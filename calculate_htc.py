@@ -1,6 +1,9 @@
 import os
 import rasterio
 import numpy as np
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from numba import njit
 from rasterio import open as rio_open
 from rasterio.enums import Resampling
 
@@ -8,62 +11,97 @@ year = 2002
 res = "9KM"
 # res = "30KM"
 
-for year in range(1997, 2025):
-    # list of tiffs for one year - temp
-    files_T = []
-    # Specify paths where temperature data is stored
-    files_T.extend([os.path.join("PATH_TO_TEMP_DATA_1", str(year), f) 
-                    for f in os.listdir(os.path.join("PATH_TO_TEMP_DATA_1", str(year))) if f.endswith('.tif')])
-    files_T.extend([os.path.join("PATH_TO_TEMP_DATA_2", str(year), f) 
-                    for f in os.listdir(os.path.join("PATH_TO_TEMP_DATA_2", str(year))) if f.endswith('.tif')])
-    
+# number of worker processes - each year is computed independently
+n_workers = os.cpu_count()
+
+# HTC for one block: sum of precipitation over sum of temperatures, NA where temperatures sum to 0
+# (single-threaded - the years already run in parallel processes; compiled once and cached for all workers)
+@njit(cache=True)
+def htc_kernel(T_stack, P_stack, out):
+    for i in range(out.shape[0]):
+        for j in range(out.shape[1]):
+            t = 0.0
+            for k in range(T_stack.shape[0]):
+                t += T_stack[k, i, j]
+            p = 0.0
+            for k in range(P_stack.shape[0]):
+                p += P_stack[k, i, j]
+            out[i, j] = p / t if t != 0 else np.nan
+
+# list tiffs under data directories holding one subdirectory per year - each directory is scanned once
+def list_tifs_by_year(roots):
+    files_by_year = defaultdict(list)
+    for root in roots:
+        with os.scandir(root) as year_dirs:
+            for year_dir in year_dirs:
+                if year_dir.is_dir():
+                    with os.scandir(year_dir.path) as it:
+                        files_by_year[year_dir.name].extend(sorted(e.path for e in it if e.name.endswith('.tif')))
+    return files_by_year
+
+def process_year(year, files_T, files_P):
     # create stack of one year - temp
     rs_T = [rio_open(f) for f in files_T]
     
-    # list of tiffs for one year - precipitation
-    files_P = []
-    # Specify paths where precipitation data is stored
-    files_P.extend([os.path.join("PATH_TO_PRECIP_DATA_1", str(year), f) 
-                    for f in os.listdir(os.path.join("PATH_TO_PRECIP_DATA_1", str(year))) if f.endswith('.tif')])
-    files_P.extend([os.path.join("PATH_TO_PRECIP_DATA_2", str(year), f) 
-                    for f in os.listdir(os.path.join("PATH_TO_PRECIP_DATA_2", str(year))) if f.endswith('.tif')])
-    
     # create stack of one year - precipitation
     rs_P = [rio_open(f) for f in files_P]
     
-    # calculate sum of temperatures for actual decade and 3 previous decades - for each 10 day period
-    TEMP = np.sum(np.array([r.read(1) for r in rs_T]), axis=0)
-    
-    # calculate sum of total precipitation for actual decade and 3 previous decades - for each 10 day period
-    OPAD = np.sum(np.array([r.read(1) for r in rs_P]), axis=0)
-    
-    # calculate HTC for each decade over the year
-    HTC = OPAD / TEMP
-    # exclude decades with NA
-    HTC = np.where(np.isnan(HTC), np.nan, HTC)
+    # calculate sum of temperatures and of total precipitation for actual decade and 3 previous decades,
+    # then HTC for each decade over the year - sums and division are fused in one pass per block,
+    # decades with NA stay NA
+    # arrays are kept in float32, the same type as the saved raster
+    HTC = np.empty(rs_T[0].shape, dtype=np.float32)
+    for _, w in rs_T[0].block_windows(1):
+        T_stack = np.stack([r.read(1, window=w, out_dtype='float32') for r in rs_T])
+        P_stack = np.stack([r.read(1, window=w, out_dtype='float32') for r in rs_P])
+        htc_kernel(T_stack, P_stack, HTC[w.toslices()])
     
     # save raster - each band is each decade
     output_path = f"PATH_TO_SAVE_HTC/HTC_{res}/HTC_{year}.tif"
     with rio_open(output_path, 'w', driver='GTiff', height=HTC.shape[0], width=HTC.shape[1], count=1, dtype='float32') as dst:
         dst.write(HTC, 1)
 
-# directory - yearly mean HTC
-htc_dir = "PATH_TO_HTC_DATA/"
-# list of all tiffs
-htc_list = [os.path.join(htc_dir, f) for f in os.listdir(htc_dir) if f.endswith('.tif')]
+    for r in rs_T + rs_P:
+        r.close()
+
+if __name__ == "__main__":
+    # list of tiffs for each year - temp
+    # Specify paths where temperature data is stored
+    files_T = list_tifs_by_year(["PATH_TO_TEMP_DATA_1", "PATH_TO_TEMP_DATA_2"])
+    # list of tiffs for each year - precipitation
+    # Specify paths where precipitation data is stored
+    files_P = list_tifs_by_year(["PATH_TO_PRECIP_DATA_1", "PATH_TO_PRECIP_DATA_2"])
+
+    years = range(1997, 2025)
+    for y in years:
+        if not files_T[str(y)] or not files_P[str(y)]:
+            raise FileNotFoundError(f"No temperature or precipitation tiffs found for year {y}")
+    with ProcessPoolExecutor(max_workers=n_workers) as ex:
+        list(ex.map(process_year, years, [files_T[str(y)] for y in years], [files_P[str(y)] for y in years]))
+
+    # directory - yearly mean HTC
+    htc_dir = "PATH_TO_HTC_DATA/"
+    # list of all tiffs
+    htc_list = [os.path.join(htc_dir, f) for f in os.listdir(htc_dir) if f.endswith('.tif')]
 
-htc_years = list(range(2001, 2025))
-htc_list = [f for f in htc_list if f[4:8] in map(str, htc_years)]
+    htc_years = list(range(2001, 2025))
+    htc_list = [f for f in htc_list if f[4:8] in map(str, htc_years)]
 
-# create stack
-htc_MULTI = [rio_open(f) for f in htc_list]
+    # create stack - preallocated and filled year by year (tiles decoded with multiple threads)
+    with rio_open(htc_list[0]) as r:
+        htc_shape = r.shape
+    htc_MULTI = np.empty((len(htc_list), *htc_shape), dtype=np.float32)
+    for i, f in enumerate(htc_list):
+        with rio_open(f, NUM_THREADS='ALL_CPUS') as r:
+            r.read(1, out=htc_MULTI[i])
 
-# calculate multiyear median of HTC - mean of yearly HTC
-HTC_MEDIAN = np.median(np.array([r.read(1) for r in htc_MULTI]), axis=0)
-# 0 to NA
-HTC_MEDIAN[HTC_MEDIAN < 0] = np.nan
+    # calculate multiyear median of HTC - mean of yearly HTC
+    # the stack is not used afterwards, so the median may partition it in place
+    HTC_MEDIAN = np.median(htc_MULTI, axis=0, overwrite_input=True)
+    # 0 to NA
+    HTC_MEDIAN[HTC_MEDIAN < 0] = np.nan
 
-# save raster
-output_median_path = f"PATH_TO_SAVE_MEDIAN/HTC_median_{htc_years[0]}_{htc_years[-1]}.tif"
-with rio_open(output_median_path, 'w', driver='GTiff', height=HTC_MEDIAN.shape[0], width=HTC_MEDIAN.shape[1], count=1, dtype='float32') as dst:
-    dst.write(HTC_MEDIAN, 1)
+    # save raster
+    output_median_path = f"PATH_TO_SAVE_MEDIAN/HTC_median_{htc_years[0]}_{htc_years[-1]}.tif"
+    with rio_open(output_median_path, 'w', driver='GTiff', height=HTC_MEDIAN.shape[0], width=HTC_MEDIAN.shape[1], count=1, dtype='float32') as dst:
+        dst.write(HTC_MEDIAN, 1)
@@ -33,6 +33,16 @@ import numpy as np
 import rasterio
 from osgeo import gdal, osr
 
+# GDAL settings for reading many TCI files: no directory scan on each open,
+# a larger block cache (MB) and multi-threaded decoding
+gdal_config = {
+    'GDAL_DISABLE_READDIR_ON_OPEN': 'EMPTY_DIR',
+    'GDAL_CACHEMAX': '1024',
+    'GDAL_NUM_THREADS': 'ALL_CPUS',
+}
+for key, value in gdal_config.items():
+    gdal.SetConfigOption(key, value)
+
 # Define directories
 base_dir = os.getcwd()  # Use the current working directory
 output_dir = os.path.join(base_dir, 'Uklad92')
@@ -47,13 +57,17 @@ if not os.path.exists(landwater_path) or not os.path.exists(tci_colour_path):
     print("Land-water mask or TCI color file not found in the current directory. Exiting.")
     exit()
 
-# Helper function to apply map projection
-def apply_map_projection(input_path, output_path, params, projection_epsg=2180):
-    dataset = gdal.Open(input_path)
-    if not dataset:
-        print(f"Failed to open input file: {input_path}")
-        return
-    
+# Helper function to hold a single-band uint8 array as an in-memory GDAL dataset
+def to_mem_dataset(data, transform, crs):
+    dataset = gdal.GetDriverByName('MEM').Create('', data.shape[1], data.shape[0], 1, gdal.GDT_Byte)
+    dataset.SetGeoTransform(transform.to_gdal())
+    if crs is not None:
+        dataset.SetProjection(crs.to_wkt())
+    dataset.GetRasterBand(1).WriteArray(data)
+    return dataset
+
+# Helper function to apply map projection (input is an already open GDAL dataset)
+def apply_map_projection(src_ds, output_path, params, projection_epsg=2180):
     # Set projection
     projection = osr.SpatialReference()
     projection.ImportFromEPSG(projection_epsg)
@@ -67,7 +81,7 @@ def apply_map_projection(input_path, output_path, params, projection_epsg=2180):
         srcNodata=255,
         dstNodata=255
     )
-    gdal.Warp(output_path, dataset, options=warp_options)
+    gdal.Warp(output_path, src_ds, options=warp_options)
     print(f"Projected file saved: {output_path}")
 
 # Input starting and ending dates
@@ -95,35 +109,24 @@ for year in range(start_year, end_year):
         input_file = input_files[0]
         print(f"Processing file: {input_file}")
         
-        # Open the input file with rasterio
-        with rasterio.open(input_file) as src:
+        # Open the input file with rasterio (using the same GDAL settings)
+        with rasterio.Env(**gdal_config), rasterio.open(input_file, NUM_THREADS='ALL_CPUS') as src:
             data = src.read(1)  # Read first band
             transform = src.transform
             crs = src.crs
         
         # Apply scaling and conditional logic (example calculation)
-        scaled_data = np.where((data >= 0) & (data <= 10000), ((data / 100) + 1), 108)
-        scaled_data = scaled_data.astype(np.uint8)
+        # integer division on the valid pixels only, written straight into the uint8 result
+        scaled_data = np.full(data.shape, 108, dtype=np.uint8)
+        valid = (data >= 0) & (data <= 10000)
+        scaled_data[valid] = data[valid] // 100 + 1
 
-        # Save the scaled data
-        scaled_output_path = os.path.join(output_dir, f"{file_code}_scaled.tif")
-        with rasterio.open(
-            scaled_output_path,
-            'w',
-            driver='GTiff',
-            height=scaled_data.shape[0],
-            width=scaled_data.shape[1],
-            count=1,
-            dtype='uint8',
-            crs=crs,
-            transform=transform,
-        ) as dst:
-            dst.write(scaled_data, 1)
-        print(f"Saved scaled file: {scaled_output_path}")
+        # Keep the scaled data in memory for the reprojection
+        scaled_dataset = to_mem_dataset(scaled_data, transform, crs)
         
         # Apply map projection and save projected file
         projected_output_path = os.path.join(output_dir, f"{file_code}_92.tif")
-        apply_map_projection(scaled_output_path, projected_output_path, params={
+        apply_map_projection(scaled_dataset, projected_output_path, params={
             "scale_factor": 0.9993,
             "false_easting": 500000,
             "false_northing": -5300000,
@@ -131,10 +134,12 @@ for year in range(start_year, end_year):
         })
 
         # Example color transformation logic
-        color_mapped_data = np.where(data == 0, 109, scaled_data)
+        # (scaled data is not needed after the reprojection, so only the masked pixels are overwritten in place)
+        color_mapped_data = scaled_data
+        color_mapped_data[data == 0] = 109
         color_output_path = os.path.join(base_dir, f"{file_code}.tif")
         
-        # Save the color-mapped file
+        # Save the color-mapped file - tiled and compressed
         with rasterio.open(
             color_output_path,
             'w',
@@ -145,7 +150,14 @@ for year in range(start_year, end_year):
             dtype='uint8',
             crs=crs,
             transform=transform,
+            tiled=True,
+            blockxsize=512,
+            blockysize=512,
+            compress='DEFLATE',
+            predictor=2,
+            num_threads='ALL_CPUS',
         ) as dst:
+            # (each band is written from the same 2D array, so no 3-band copy is held in memory)
             dst.write(color_mapped_data, 1)  # Red band
             dst.write(color_mapped_data, 2)  # Green band
             dst.write(color_mapped_data, 3)  # Blue band
@@ -6,7 +6,7 @@
 # - Saves the final data to specific formats (e.g., GeoTIFF)
 #
 # Requirements:
-# - Python with libraries: os, glob, numpy, rasterio, and GDAL
+# - Python with libraries: os, glob, numpy, numba, rasterio, and GDAL
 # - Ensure input files (era5_htc_30_median.img, meadow_arable_mask_snap.img, and tci) are in the working directory
 # - In order to specify coefficients please read the research papers 
 #   https://doi.org/10.3390/rs12182944
@@ -26,10 +26,11 @@
 # ----------------------------------------------------------
 
 import os
+import math
 import numpy as np
-from osgeo import gdal
-import matplotlib.pyplot as plt
-from matplotlib.colors import ListedColormap
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from numba import config, set_num_threads, vectorize
+from osgeo import gdal, gdal_array
 
 # Set paths
 home_path = "D:/FPCUP BALTIC/"
@@ -39,6 +40,13 @@ path_out = "D:/FPCUP BALTIC/DISS/"
 year = "2022"  # Adjust the year as necessary
 dekad = ["05", "06", "07", "08", "09", "10", "11", "12", "13", "14", "15", "16", "17", "18", "19", "20", "21", "22", "23", "24", "25", "26", "27", "28", "29", "30"]
 
+# number of worker processes - each one processes a run of at least min_dekads consecutive dekads
+n_workers = os.cpu_count()
+min_dekads = 4
+
+# Class limits for DISS values (float32, the type DISS is written with)
+diss_bins = np.array([0.0, 0.5, 0.8, 1.5, 5.0, np.inf], dtype=np.float32)
+
 # Coefficients to be specified for the DISS formula
 a = ?.?  # please set coefficient value for n1_memory
 b = ?.?  # please set coefficient value for n2_memory
@@ -51,73 +59,113 @@ def read_raster(file_path):
     dataset = gdal.Open(file_path)
     return dataset.ReadAsArray(), dataset.GetGeoTransform(), dataset.GetProjection()
 
-# Helper function to write raster
+# Helper function to write raster (tiled and compressed)
+# (the GDAL data type follows the array type, e.g. Float32 for DISS values and Byte for classes)
 def write_raster(output_path, data, geo_transform, projection):
     driver = gdal.GetDriverByName('GTiff')
-    out_ds = driver.Create(output_path, data.shape[1], data.shape[0], 1, gdal.GDT_Float32)
+    data_type = gdal_array.NumericTypeCodeToGDALTypeCode(data.dtype)
+    out_ds = driver.Create(output_path, data.shape[1], data.shape[0], 1, data_type,
+                           options=['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'COMPRESS=DEFLATE'])
     out_ds.SetGeoTransform(geo_transform)
     out_ds.SetProjection(projection)
     out_ds.GetRasterBand(1).WriteArray(data)
     out_ds.FlushCache()
 
+# DISS formula for one pixel - TCI gaps (> 101) are filled and the mask is applied in the same pass
+# (computed in float32, the type DISS is written and classified with)
+@vectorize(['float32(float32, float32, float32, float32, boolean)'], target='parallel')
+def diss(n1_tci1, n2_tci2, n3_tci3, n5_siel40median, n6_mask):
+    if not n6_mask:
+        return -1.0
+    n1_memory = n1_tci1 if n1_tci1 <= 101 else 50.0
+    n2_memory = n2_tci2 if n2_tci2 <= 101 else 0.5 * (n1_tci1 + n3_tci3)
+    n3_memory = n3_tci3 if n3_tci3 <= 101 else 50.0
+    return (n5_siel40median - diss_base) * math.exp(2 * (exp_factor + a * n1_memory + b * n2_memory + c * n3_memory))
+
 # Function for processing one year and dekad combination
-def process_year_dekad(year, dekad):
-    for d in dekad:
-        # File paths for TCI and other datasets
-        ftci1 = tci_path + "tci" + year + d + ".img"
-        ftci2 = tci_path + "tci" + year + str(int(d)-1).zfill(2)  # previous dekad
-        ftci3 = tci_path + "tci" + year + str(int(d)-2).zfill(2)  # two dekads ago
-        
-        fout = path_out + "diss_" + year + d + ".tif"
-        fout_kl = path_out + "diss_" + year + d + "_kl.tif"
-
-        # Read input rasters
-        n1_tci1, geo_transform, projection = read_raster(ftci1)
-        n2_tci2, _, _ = read_raster(ftci2)
-        n3_tci3, _, _ = read_raster(ftci3)
-        n5_siel40median, _, _ = read_raster("D:/FPCUP BALTIC/era5_htc_30_median.img") #HTC median file to be delivered from ERA5-Land product
-        n6_mask, _, _ = read_raster("D:/FPCUP BALTIC/meadow_arable_mask_snap.img") #meadows and arable lands mask file
-
-        # Apply calculations for the 'diss' raster
-        n1_memory = np.where(n1_tci1 <= 101, n1_tci1, 50)
-        n2_memory = np.where(n2_tci2 <= 101, n2_tci2, 0.5 * (n1_tci1 + n3_tci3))
-        n3_memory = np.where(n3_tci3 <= 101, n3_tci3, 50)
-
-        # DISS formula (with coefficients a, b, c)
-        n4_diss = (n5_siel40median - diss_base) * np.exp(2 * (exp_factor + a * n1_memory + b * n2_memory + c * n3_memory))
-
-        # Apply the mask
-        n4_diss = np.where(n6_mask == 1, n4_diss, -1)
-
-        # Write output raster for 'diss'
-        write_raster(fout, n4_diss, geo_transform, projection)
-
-        # Apply classification to 'diss' values
-        n2_diss_kl = np.digitize(n4_diss, bins=[0.0, 0.5, 0.8, 1.5, 5.0, np.inf])
-        write_raster(fout_kl, n2_diss_kl, geo_transform, projection)
-
-        # Apply color table
-        apply_color_table(n2_diss_kl, year, d)
-
-        print(f"Processing complete for {year}-{d}")
+# (n5_siel40median and n6_mask are shared by all dekads and read once in main)
+def process_year_dekad(year, dekad, n5_siel40median, n6_mask):
+    # TCI rasters being read or already read, by dekad - consecutive dekads share two of their three TCI files,
+    # so each file is read once and reads run in a background thread ahead of the calculations
+    tci_cache = {}
+    with ThreadPoolExecutor(max_workers=1) as prefetch:
+        def read_tci(dk):
+            if dk not in tci_cache:
+                tci_cache[dk] = prefetch.submit(read_raster, tci_path + "tci" + year + str(dk).zfill(2) + ".img")
+            return tci_cache[dk]
+
+        for i, d in enumerate(dekad):
+            fout = path_out + "diss_" + year + d + ".tif"
+            fout_kl = path_out + "diss_" + year + d + "_kl.tif"
+
+            # Read input rasters
+            n1_tci1, geo_transform, projection = read_tci(int(d)).result()
+            n2_tci2, _, _ = read_tci(int(d) - 1).result()  # previous dekad
+            n3_tci3, _, _ = read_tci(int(d) - 2).result()  # two dekads ago
+            # the oldest dekad is not needed any more, the next one is read while this one is processed
+            tci_cache.pop(int(d) - 2)
+            if i + 1 < len(dekad):
+                read_tci(int(dekad[i + 1]))
+
+            # DISS formula (with coefficients a, b, c) with the mask applied
+            # (float64 inputs, e.g. a Float64 HTC median, are cast to float32)
+            n4_diss = diss(n1_tci1, n2_tci2, n3_tci3, n5_siel40median, n6_mask, dtype=np.float32)
+
+            # Write output raster for 'diss'
+            write_raster(fout, n4_diss, geo_transform, projection)
+
+            # Apply classification to 'diss' values
+            # (bins are sorted, so searchsorted gives the same classes as np.digitize without its checks)
+            n2_diss_kl = np.searchsorted(diss_bins, n4_diss, side='right').astype(np.uint8)
+            write_raster(fout_kl, n2_diss_kl, geo_transform, projection)
+
+            # Apply color table
+            apply_color_table(n2_diss_kl, geo_transform, projection, year, d)
+
+            print(f"Processing complete for {year}-{d}")
 
 # Function to apply color table
-def apply_color_table(raster_data, year, d):
-    # For visualization (coloring)
-    cmap = ListedColormap(['#0000FF', '#00FF00', '#FFFF00', '#FF0000', '#FF00FF'])  # Example colors
-    fig, ax = plt.subplots()
-    cax = ax.imshow(raster_data, cmap=cmap)
-    fig.colorbar(cax)
-
-    # Save the colored output
-    color_output = path_out + "diss_kl_color_" + year + d + ".png"
-    plt.savefig(color_output)
-    plt.close(fig)
+def apply_color_table(raster_data, geo_transform, projection, year, d):
+    # For visualization (coloring) - one color per DISS class
+    colors = [(0, 0, 255, 255), (0, 255, 0, 255), (255, 255, 0, 255), (255, 0, 0, 255), (255, 0, 255, 255)]  # Example colors
+    color_table = gdal.ColorTable()
+    color_table.SetColorEntry(0, (0, 0, 0, 0))  # outside meadows and arable lands (masked) - transparent, set as nodata
+    for class_value, color in enumerate(colors, start=1):
+        color_table.SetColorEntry(class_value, color)
+    color_table.SetColorEntry(6, (128, 128, 128, 255))  # DISS could not be calculated (infinite or NA) - grey
+
+    # Save the colored output as a paletted GeoTIFF
+    color_output = path_out + "diss_kl_color_" + year + d + ".tif"
+    driver = gdal.GetDriverByName('GTiff')
+    out_ds = driver.Create(color_output, raster_data.shape[1], raster_data.shape[0], 1, gdal.GDT_Byte, options=['TILED=YES', 'COMPRESS=DEFLATE'])
+    out_ds.SetGeoTransform(geo_transform)
+    out_ds.SetProjection(projection)
+    band = out_ds.GetRasterBand(1)
+    band.SetColorTable(color_table)
+    band.SetNoDataValue(0)
+    band.WriteArray(raster_data)
+    out_ds.FlushCache()
+
+# Function to set up a worker process - numba threads are shared out so that all workers together use each core once
+# (numba cannot use more threads than NUMBA_NUM_THREADS, which follows the cores available to the process)
+def init_worker(n_threads):
+    set_num_threads(max(1, min(config.NUMBA_NUM_THREADS, n_threads)))
 
 # Main function to process the year and dekads
 def main():
     print("Starting processing...")
-    process_year_dekad(year, dekad)
+    # Rasters shared by all dekads are read once
+    n5_siel40median, _, _ = read_raster("D:/FPCUP BALTIC/era5_htc_30_median.img") #HTC median file to be delivered from ERA5-Land product
+    n6_mask, _, _ = read_raster("D:/FPCUP BALTIC/meadow_arable_mask_snap.img") #meadows and arable lands mask file
+    n6_mask = n6_mask == 1
+
+    # dekads are independent, but consecutive ones share TCI files - each worker gets a run of consecutive dekads
+    chunk_size = max(-(-len(dekad) // n_workers), min_dekads)
+    dekad_chunks = [dekad[i:i + chunk_size] for i in range(0, len(dekad), chunk_size)]
+    n_threads = max(1, config.NUMBA_NUM_THREADS // len(dekad_chunks))
+    with ProcessPoolExecutor(max_workers=len(dekad_chunks), initializer=init_worker, initargs=(n_threads,)) as ex:
+        list(ex.map(process_year_dekad, [year] * len(dekad_chunks), dekad_chunks,
+                    [n5_siel40median] * len(dekad_chunks), [n6_mask] * len(dekad_chunks)))
     print("Processing complete!")
 
 if __name__ == "__main__":